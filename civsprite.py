@@ -3,45 +3,46 @@
 __version__ = '2.0.0'
 
 import argparse
+import importlib
+import os
 import sys
 
-import sprite.format.json
-import sprite.format.spr
-import sprite.format.txt
 
+# Supported file extensions, each implemented by the sprite.format module with
+# the same name. Only the modules that are actually used get imported.
+_FORMATS = ('json', 'spr', 'txt')
 
-def _input_format(name):
-    input_formats = {
-        'json': sprite.format.json.load,
-        'spr': sprite.format.spr.load,
-        'txt': sprite.format.txt.load
-    }
-    split_name = name.rsplit('.', 1)
-    if split_name[-1] not in input_formats:
-        format_string = ', '.join(input_formats)
+
+def _resolve(function, name):
+    """Return function from the format module for the file extension of name"""
+    extension = os.path.splitext(name)[1][1:].lower()
+    if extension not in _FORMATS:
+        format_string = ', '.join(_FORMATS)
         raise argparse.ArgumentTypeError(
             f'"{name}" does not have a supported file extension.\n'
             'Only the following extensions are supported:\n'
             + format_string)
-    else:
-        return lambda: input_formats[split_name[-1]](name)
+    module = importlib.import_module(f'sprite.format.{extension}')
+    return getattr(module, function)
+
+
+def _input_format(name):
+    load = _resolve('load', name)
+    return lambda: load(name)
 
 
 def _output_format(name):
-    output_formats = {
-        'json': sprite.format.json.save,
-        'spr': sprite.format.spr.save,
-        'txt': sprite.format.txt.save
-    }
-    split_name = name.rsplit('.', 1)
-    if split_name[-1] not in output_formats:
-        format_string = ', '.join(output_formats)
-        raise argparse.ArgumentTypeError(
-            f'"{name}" does not have a supported file extension.\n'
-            'Only the following extensions are supported:\n'
-            + format_string)
-    else:
-        return lambda data: output_formats[split_name[-1]](data, name)
+    save = _resolve('save', name)
+    return lambda data: save(data, name)
+
+
+def _error_message(exception):
+    """Return message describing exception and the exceptions it came from"""
+    messages = []
+    while exception:
+        messages.append(str(exception))
+        exception = exception.__cause__ or exception.__context__
+    return '\n  '.join(messages)
 
 
 if __name__ == '__main__':
@@ -103,8 +104,4 @@ references into a Test of Time sprite file:
         if args.debug:
             raise
         else:
-            message = ''
-            while e:
-                message += f'{e}\n  '
-                e = e.__cause__ or e.__context__
-            sys.exit(message)
+            sys.exit(_error_message(e))
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 
 import os
+import threading
 import tkinter as tk
 import tkinter.filedialog
 import tkinter.messagebox
+import tkinter.ttk
 
 import civsprite
 
@@ -23,6 +25,7 @@ TEXT = {
     'warn_no_files': 'Choose input and output files first.',
     'info_done': 'Done!'
 }
+POLL_INTERVAL = 100  # milliseconds between checks if conversion is done
 
 
 class SpriteApplication(tk.Frame):
@@ -34,22 +37,26 @@ class SpriteApplication(tk.Frame):
 
         self.input = None
         self.output = None
+        self.conversion = None
+        self.conversion_error = None
 
         self.create_widgets()
 
     def create_widgets(self):
         self.input_button = tk.Button(
             self, text=TEXT['input_button'], command=self.get_input)
-        self.input_button.pack(side='top')
+        self.input_button.grid(row=0, column=0, columnspan=2)
         self.output_button = tk.Button(
             self, text=TEXT['output_button'], command=self.get_output)
-        self.output_button.pack(side='top')
+        self.output_button.grid(row=1, column=0, columnspan=2)
+        self.progress_bar = tk.ttk.Progressbar(self, mode='indeterminate')
+        self.progress_bar.grid(row=2, column=0, columnspan=2, sticky='ew')
         self.convert_button = tk.Button(
             self, text=TEXT['convert_button'], command=self.convert)
-        self.convert_button.pack(side='left')
+        self.convert_button.grid(row=3, column=0, sticky='w')
         self.quit_button = tk.Button(
             self, text=TEXT['exit_button'], command=self.parent.destroy)
-        self.quit_button.pack(side='right')
+        self.quit_button.grid(row=3, column=1, sticky='e')
 
     def get_input(self):
         self.input = tk.filedialog.askopenfilename(
@@ -73,19 +80,38 @@ class SpriteApplication(tk.Frame):
                 tk.messagebox.showerror(message=TEXT['error_output_exists'])
 
     def convert(self):
+        if not (self.input and self.output):
+            tk.messagebox.showwarning(message=TEXT['warn_no_files'])
+            return
+        # Convert in a separate thread, so the window stays responsive.
+        # It's not a daemon thread, so that closing the window does not stop
+        # the conversion halfway through writing the output.
+        self.conversion = threading.Thread(
+            target=self.run_conversion, args=(self.input, self.output))
+        self.convert_button['state'] = 'disabled'
+        self.progress_bar.start()
+        self.conversion.start()
+        self.after(POLL_INTERVAL, self.check_conversion)
+
+    def run_conversion(self, input_path, output_path):
+        """Convert input to output file. Runs outside of the Tk thread."""
+        self.conversion_error = None
         try:
-            if self.input and self.output:
-                data = civsprite._input_format(self.input)()
-                civsprite._output_format(self.output)(data)
-            else:
-                tk.messagebox.showwarning(
-                    message=TEXT['warn_no_files'])
+            load = civsprite._resolve('load', input_path)
+            save = civsprite._resolve('save', output_path)
+            save(load(input_path), output_path)
         except Exception as e:
-            message = ''
-            while e:
-                message += f'{e}\n  '
-                e = e.__cause__ or e.__context__
-            tk.messagebox.showerror(message=message)
+            self.conversion_error = e
+
+    def check_conversion(self):
+        if self.conversion.is_alive():
+            self.after(POLL_INTERVAL, self.check_conversion)
+            return
+        self.progress_bar.stop()
+        self.convert_button['state'] = 'normal'
+        if self.conversion_error:
+            tk.messagebox.showerror(
+                message=civsprite._error_message(self.conversion_error))
         else:
             tk.messagebox.showinfo(message=TEXT['info_done'])
 
@@ -4,17 +4,24 @@ import os
 from sprite.objects import Frame, ImageDetails, Sprite
 
 
+# ImageDetails fields that are calculated from the other fields:
+_DERIVED_IMAGE_FIELDS = frozenset(('image_box', 'mask_box'))
+
+
 def load(path):
     with open(path, 'rt') as f:
         sprite = json.load(f)
     images = []
-    for n, img in enumerate(sprite['images']):
+    loaded_images = {}
+    sources = {}
+    for img in sprite['images']:
+        image_details = ImageDetails(**img)
         # Don't load the same image twice:
-        first_occurrence = sprite['images'].index(img)
-        if first_occurrence == n:
-            images.append(ImageDetails(**img).load())
+        if image_details in loaded_images:
+            images.append(images[loaded_images[image_details]])
         else:
-            images.append(images[first_occurrence])
+            images.append(image_details.load(sources))
+            loaded_images[image_details] = len(images) - 1
     frames = sprite.get('frames')
     animations = None
     if frames:
@@ -26,23 +33,25 @@ def load(path):
 def save(sprite, path):
     """Save Sprite object 'sprite' to .json file 'path'"""
 
-    # Open json file early, so we already own it when writing the images:
-    with open(path, 'xt') as f:
-        try:
-            img_list = sprite.save_as_pngs(os.path.splitext(path)[0])
-        except FileExistsError as e:
-            # But if creating the image directory failed, we have no use for
-            # the json file anymore either:
-            f.close()
-            os.remove(f.name)
-            raise FileExistsError('Image directory already exists.') from e
-        sprite_json = {'images': []}
-        for img in img_list:
-            detail = img._asdict()
-            del detail['image_box']
-            del detail['mask_box']
-            sprite_json['images'].append(detail)
-        if sprite.has_animations:
-            sprite_json['frames'] = [f._asdict() for f in sprite.frames]
-            sprite_json['animations'] = sprite.animation_index[:]
-        json.dump(sprite_json, f)
+    # Create json file early, so we already own it when writing the images.
+    # It is only opened for writing once the images are done:
+    open(path, 'xt').close()
+    try:
+        img_list = sprite.save_as_pngs(os.path.splitext(path)[0])
+    except FileExistsError as e:
+        # But if creating the image directory failed, we have no use for the
+        # json file anymore either:
+        os.remove(path)
+        raise FileExistsError('Image directory already exists.') from e
+    sprite_json = {'images': []}
+    for img in img_list:
+        sprite_json['images'].append({
+            field: getattr(img, field) for field in img._fields
+            if field not in _DERIVED_IMAGE_FIELDS
+        })
+    if sprite.has_animations:
+        sprite_json['frames'] = [f._asdict() for f in sprite.frames]
+        sprite_json['animations'] = sprite.animation_index
+    # Unlike json.dump(), json.dumps() can use the C-accelerated encoder:
+    with open(path, 'wt') as f:
+        f.write(json.dumps(sprite_json, separators=(',', ':')))
@@ -1,5 +1,7 @@
-import io
+import array
+import mmap
 import struct
+import sys
 
 from PIL import Image, ImageChops
 
@@ -9,6 +11,28 @@ import sprite.objects
 FILE_HEADER_STRUCT = struct.Struct('<3l')
 IMAGE_HEADER_STRUCT = struct.Struct('<16x6lBl')
 IMAGE_ROW_HEADER_STRUCT = struct.Struct('<2l')
+PIXEL_STRUCT = struct.Struct('<H')
+
+
+def _unpack_int32_array(data, start, end):
+    """Return array of little-endian 32-bit integers in data[start:end]"""
+
+    values = array.array('i')
+    assert values.itemsize == 4
+    values.frombytes(data[start:end - (end - start) % 4])
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def _pack_int32_array(values):
+    """Return bytes of values as little-endian 32-bit integers"""
+
+    values = array.array('i', values)
+    assert values.itemsize == 4
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values.tobytes()
 
 
 def _rgbm_to_int(rgbm):
@@ -29,51 +53,84 @@ def _int_to_rgbm(color):
     return tuple(rgbm)
 
 
-def _read_spr_image(spr_file):
-    """Return PIL Image for image at current location in spr_file object."""
+# Pillow's raw decoder for 15-bit colors scales the 5-bit color channels with
+# c * 255 // 31. Map its results to the values _int_to_rgbm() uses instead.
+_DECODED_CHANNEL_MAP = {c * 255 // 31: _int_to_rgbm(c)[2] for c in range(32)}
+_DECODED_RGBM_LUT = (
+    [_DECODED_CHANNEL_MAP.get(v, v) for v in range(256)] * 3 +
+    list(range(256)))  # Mask values stay the same
+
+
+def _read_spr_image(spr_data, offset):
+    """Return PIL Image for image at offset in spr_data and the next offset."""
 
     (width, height, left, top, right, bottom, bgcolor, size) = \
-        IMAGE_HEADER_STRUCT.unpack(spr_file.read(IMAGE_HEADER_STRUCT.size))
+        IMAGE_HEADER_STRUCT.unpack_from(spr_data, offset)
+    offset += IMAGE_HEADER_STRUCT.size
+    next_offset = offset + size
 
-    # Turn bits CCCCCBGR (with Cs the 5-bit color channel value) into RGBm.
-    # Use _int_to_rgbm() to get consistent 16-bit to 24-bit color conversion.
+    # Turn bits CCCCCBGR (with Cs the 5-bit color channel value) into the same
+    # 16-bit color format as the pixels in the image rows.
     bgchannel = bgcolor >> 3
-    bgcolor = _int_to_rgbm(
+    bgcolor = PIXEL_STRUCT.pack(
         (((bgcolor & 1) * bgchannel) << 10) +  # R
         (((bgcolor & 2) * bgchannel) << 4) +  # G
         (((bgcolor & 4) * bgchannel) >> 2))  # B
 
+    # Collect the raw 16-bit pixels and let Pillow decode them all at once.
     # empty lines above bounding box
-    image_data = [bgcolor] * width * top
-
-    while size > 10:
-        (empty_bytes, row_bytes) = IMAGE_ROW_HEADER_STRUCT.unpack(
-            spr_file.read(IMAGE_ROW_HEADER_STRUCT.size))
-        size -= IMAGE_ROW_HEADER_STRUCT.size
-
-        if empty_bytes:
-            image_data.extend([bgcolor] * (empty_bytes // 2))
-        if row_bytes:
-            image_data.extend(
-                map(_int_to_rgbm,
-                    struct.unpack(
-                        '<{}H'.format(row_bytes // 2),
-                        spr_file.read(row_bytes))))
-            size -= row_bytes
+    image_data = bytearray(bgcolor * width * top)
+
+    # The rows are followed by 10 null bytes:
+    while offset < next_offset - 10:
+        (empty_bytes, row_bytes) = IMAGE_ROW_HEADER_STRUCT.unpack_from(
+            spr_data, offset)
+        offset += IMAGE_ROW_HEADER_STRUCT.size
+
+        image_data += bgcolor * (empty_bytes // 2)
+        image_data += spr_data[offset:offset + row_bytes]
+        offset += row_bytes
 
         # empty pixels at end of line
-        image_data.extend([bgcolor] * (width - (empty_bytes + row_bytes) // 2))
+        image_data += bgcolor * (width - (empty_bytes + row_bytes) // 2)
 
     # empty lines below bounding box
-    image_data.extend([bgcolor] * width * (height - bottom))
+    image_data += bgcolor * width * (height - bottom)
+
+    image = Image.frombytes(
+        'RGBA', (width, height), bytes(image_data), 'raw', 'BGRA;15')
 
-    # Skip over the trailing 10 null bytes:
-    spr_file.seek(10, io.SEEK_CUR)
+    return image.point(_DECODED_RGBM_LUT), next_offset
 
-    image = Image.new('RGBA', (width, height), None)
-    image.putdata(image_data)
 
-    return image
+def _band_lut(band_value):
+    """Return point() lookup table for RGBA images from band_value function.
+
+    band_value(band, value) is called for each band index and 8-bit value.
+    """
+    return [band_value(band, v) for band in range(4) for v in range(256)]
+
+
+def _rgbm_byte(band, value, shift):
+    """Return bits of value in band that end up in a byte of _rgbm_to_int()"""
+    rgbm = [0, 0, 0, 0]
+    rgbm[band] = value
+    return (_rgbm_to_int(rgbm) >> shift) & 255
+
+
+# Every band sets different bits of the 16-bit color, so adding up the bands
+# after applying one of these tables gives one byte of the 16-bit color.
+_RGBM_LOW_BYTE_LUT = _band_lut(lambda band, v: _rgbm_byte(band, v, 0))
+_RGBM_HIGH_BYTE_LUT = _band_lut(lambda band, v: _rgbm_byte(band, v, 8))
+# Adding up the bands after applying this gives 0 for transparent pixels:
+_NOT_TRANSPARENT_LUT = _band_lut(
+    lambda band, v: int(v != sprite.objects.TRANSPARENT[band]))
+
+
+def _add_bands(image):
+    """Return L image with the sum of the bands of an RGBA image"""
+    (r, g, b, a) = image.split()
+    return ImageChops.add(ImageChops.add(r, g), ImageChops.add(b, a))
 
 
 def _image_object_to_sprite_image(image):
@@ -87,36 +144,33 @@ def _image_object_to_sprite_image(image):
         ImageChops.difference(image.convert('RGB'), blank_image).getbbox()
     (bbox_left, bbox_top, bbox_right, bbox_bottom) = \
         bounding_box or (0, 0, 0, 0)
-    image_data = b''
+    image_data = bytearray()
 
     if bounding_box is not None:
-        bbox_data = list(image.crop(bounding_box).getdata())
+        bbox_image = image.crop(bounding_box)
         bbox_width = bbox_right - bbox_left
-
-        for n in range(0, len(bbox_data), bbox_width):
-            row = bbox_data[n:n + bbox_width]
-            # Skip leading transparent pixels
-            first_pixel = 0
-            while (first_pixel < bbox_width and
-                    row[first_pixel] == sprite.objects.TRANSPARENT):
-                first_pixel += 1
+        # Let Pillow convert all pixels to little-endian 16-bit colors:
+        bbox_data = Image.merge('LA', (
+            _add_bands(bbox_image.point(_RGBM_LOW_BYTE_LUT)),
+            _add_bands(bbox_image.point(_RGBM_HIGH_BYTE_LUT)))).tobytes()
+        opaque_data = _add_bands(
+            bbox_image.point(_NOT_TRANSPARENT_LUT)).tobytes()
+
+        for n in range(0, len(opaque_data), bbox_width):
+            row = opaque_data[n:n + bbox_width]
+            # Skip leading and trailing transparent pixels
+            first_pixel = bbox_width - len(row.lstrip(b'\0'))
+            end_pixel = len(row.rstrip(b'\0'))
 
             empty_bytes = 0
-            row_data = []
+            row_data = b''
             if first_pixel != bbox_width:
-                # Skip trailing transparent pixels
-                last_pixel = bbox_width - 1
-                while (last_pixel > first_pixel and
-                        row[last_pixel] == sprite.objects.TRANSPARENT):
-                    last_pixel -= 1
                 empty_bytes = bbox_left + first_pixel
-                row_data = [
-                    _rgbm_to_int(p) for p in row[first_pixel:last_pixel + 1]
-                ]
+                row_data = bbox_data[2 * (n + first_pixel):2 * (n + end_pixel)]
 
             image_data += IMAGE_ROW_HEADER_STRUCT.pack(
-                empty_bytes * 2, len(row_data) * 2
-            ) + struct.pack('<{}H'.format(len(row_data)), *row_data)
+                empty_bytes * 2, len(row_data))
+            image_data += row_data
 
     return IMAGE_HEADER_STRUCT.pack(
         image.width, image.height,
@@ -152,18 +206,16 @@ def load(path):
     """Load .spr file and return sprite.objects.Sprite object"""
 
     # TODO: Add error handling
-    with open(path, 'rb') as spr_file:
-        header_struct = FILE_HEADER_STRUCT
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as spr_data:
         (animation_offset, image_index_offset, images_offset) = \
-            header_struct.unpack(spr_file.read(header_struct.size))
+            FILE_HEADER_STRUCT.unpack_from(spr_data)
 
         frames = None
         animation_index = None
         if animation_offset:
-            anim_size = image_index_offset - animation_offset
-            spr_file.seek(animation_offset)
-            anim_data = list(struct.unpack('<{}l'.format(anim_size // 4),
-                                           spr_file.read(anim_size)))
+            anim_data = _unpack_int32_array(
+                spr_data, animation_offset, image_index_offset)
             first_frame = anim_data[0]
             for index, value in enumerate(anim_data):
                 if (index * 4) + animation_offset == first_frame:
@@ -176,20 +228,20 @@ def load(path):
             # turn file offsets into list indexes
             animation_index = [(i - first_frame) // 4 for i in animation_index]
 
-        image_index_size = images_offset - image_index_offset
-        spr_file.seek(image_index_offset)
-        image_index = list(struct.unpack('<{}l'.format(image_index_size // 4),
-                                         spr_file.read(image_index_size)))
+        image_index = _unpack_int32_array(
+            spr_data, image_index_offset, images_offset)
 
         image_sources = []
         image_offset_map = {}
+        offset = images_offset
         while True:
-            image_offset = spr_file.tell() - images_offset
+            image_offset = offset - images_offset
             if image_offset == image_index[-1]:  # final index points to EOF
                 image_index.pop()
                 break
             image_offset_map[image_offset] = len(image_sources)
-            image_sources.append(_read_spr_image(spr_file))
+            (image, offset) = _read_spr_image(spr_data, offset)
+            image_sources.append(image)
 
     # This is normally a no-op, but not e.g. for SpriteGen-generated spr files
     # where the index refers to each image 5 times:
@@ -200,6 +252,10 @@ def load(path):
 def save(sprite, path):
     """Save sprite.objects.Sprite object 'sprite' to .spr file 'path'"""
 
+    # Create the file early, so an existing file is reported before doing
+    # any work. It is only opened for writing once all data is ready:
+    open(path, 'xb').close()
+
     header_struct = FILE_HEADER_STRUCT
     if sprite.has_animations:
         animations_offset = header_struct.size
@@ -212,39 +268,43 @@ def save(sprite, path):
 
     first_image_offset = image_index_offset + 4 * (len(sprite.images) + 1)
 
-    with open(path, 'xb') as spr_file:
-        spr_file.write(header_struct.pack(
-            animations_offset, image_index_offset, first_image_offset))
-
-        if sprite.has_animations:
-            animation_data = [
-                animations_offset + 4 * len(sprite.animation_index) + 4 * i
-                for i in sprite.animation_index]
-            animation_data.extend(map(_frame_to_int, sprite.frames))
-            spr_file.write(
-                struct.pack('<{}l'.format(len(animation_data)),
-                            *animation_data))
-
-        assert image_index_offset == spr_file.tell()
-        # Skip past image index for now:
-        spr_file.seek(first_image_offset)
-
-        image_index = []
-        current_end = 0
-        for n, img in enumerate(sprite.images):
-            first_occurrence = next(sprite.find_matching_image_indexes(img))
-            if first_occurrence == n:
-                image_data = _image_object_to_sprite_image(img)
-                image_index.append(current_end)
-                spr_file.write(image_data)
-                current_end += len(image_data)
-            else:
-                # We've already written this image. Just add the same offset
-                # to the index again.
-                image_index.append(image_index[first_occurrence])
-        image_index.append(current_end)  # EOF
-
-        # Go back and write the image index:
-        spr_file.seek(image_index_offset)
-        spr_file.write(struct.pack('<{}l'.format(len(image_index)),
-                                   *image_index))
+    # Build the whole file in memory and write it at once
+    spr_data = bytearray(header_struct.pack(
+        animations_offset, image_index_offset, first_image_offset))
+
+    if sprite.has_animations:
+        frames_offset = animations_offset + 4 * len(sprite.animation_index)
+        spr_data += _pack_int32_array(
+            frames_offset + 4 * i for i in sprite.animation_index)
+        spr_data += _pack_int32_array(map(_frame_to_int, sprite.frames))
+
+    assert image_index_offset == len(spr_data)
+    # Leave room for the image index for now:
+    spr_data += bytes(first_image_offset - image_index_offset)
+
+    # Index of the first occurrence of each image object:
+    first_occurrences = {}
+    for n, img in enumerate(sprite.images):
+        first_occurrences.setdefault(id(img), n)
+
+    image_index = []
+    current_end = 0
+    for n, img in enumerate(sprite.images):
+        first_occurrence = first_occurrences[id(img)]
+        if first_occurrence == n:
+            image_data = _image_object_to_sprite_image(img)
+            image_index.append(current_end)
+            spr_data += image_data
+            current_end += len(image_data)
+        else:
+            # We've already written this image. Just add the same offset
+            # to the index again.
+            image_index.append(image_index[first_occurrence])
+    image_index.append(current_end)  # EOF
+
+    # Go back and fill in the image index:
+    spr_data[image_index_offset:first_image_offset] = \
+        _pack_int32_array(image_index)
+
+    with open(path, 'wb') as spr_file:
+        spr_file.write(spr_data)
@@ -5,10 +5,10 @@ itself uses.
 """
 
 import enum
-import itertools
 import os
 
-from sprite.objects import ImageDetails, Frame, Sprite, SpriteType
+from sprite.objects import (
+    ImageDetails, Frame, Sprite, SpriteType, load_sources)
 
 
 IMAGES_HEADER = '@IMAGES'
@@ -93,59 +93,64 @@ ANIMATIONS_HELP = f"""\
 ; @COSMIC2. See TOTPP for more information.
 ;"""
 
+# Frame values are ints and bools; '{:d}' writes the bools as 0 or 1.
+_FRAME_FORMAT = ', '.join(['{:d}'] * len(Frame._fields))
+_FRAME_FLAGS = {'0': False, '1': True}
+
+_UNIT_DIRECTIONS = ('N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW')
+_UNIT_ANIMATION_TITLES = tuple(
+    f'{action} {direction}'
+    for action in ('Attack', 'Die', 'Idle', 'Move')
+    for direction in _UNIT_DIRECTIONS)
+
 
 def _parse_image_details(values, root_dir):
     """Return ImageDetails object from values parsed from image text line"""
-    image = {}
     try:
-        image['image_path'] = os.path.abspath(
-            os.path.join(root_dir, values[0]))
+        # root_dir is absolute, so normpath() is enough (no abspath() needed):
+        image_path = os.path.normpath(os.path.join(root_dir, values[0]))
     except IndexError:
         raise ValueError('Image misses image path value.')
-    index = 1
-    for prop in ('image_x', 'image_y', 'width', 'height'):
+    image_values = []
+    for index, prop in enumerate(('image_x', 'image_y', 'width', 'height'), 1):
         try:
-            image[prop] = int(values[index])
-            if image[prop] < 0:
+            value = int(values[index])
+            if value < 0:
                 raise ValueError('value must be a non-negative integer.')
         except IndexError:
             raise ValueError(f'Image misses {prop} value.')
         except ValueError:
             raise ValueError(
                 f'Image has invalid {prop} value "{values[index]}".')
-        index += 1
-    try:
-        mask_path = values[5]
-        if mask_path == '':
-            image['mask_path'] = image['image_path']
-        elif mask_path:
-            image['mask_path'] = os.path.abspath(
-                os.path.join(root_dir, mask_path))
-    except IndexError:
-        pass  # This field is optional.
-    index = 6
-    for prop in ('mask_x', 'mask_y'):
+        image_values.append(value)
+    mask_path = None
+    if len(values) > 5:  # This field is optional.
+        mask_path = image_path
+        if values[5]:
+            mask_path = os.path.normpath(os.path.join(root_dir, values[5]))
+    mask_values = []
+    for index, prop in enumerate(('mask_x', 'mask_y'), 6):
         try:
-            image[prop] = int(values[index])
-            if image[prop] < 0:
+            value = int(values[index])
+            if value < 0:
                 raise ValueError('value must be a non-negative integer.')
         except IndexError:
             # The coordinates are only required if there is a mask.
-            if image.get('mask_path') is not None:
+            if mask_path is not None:
                 raise ValueError(f'Mask misses {prop} value.')
+            value = None
         except ValueError:
             raise ValueError(
                 f'Mask has invalid {prop} value "{values[index]}".')
-        index += 1
-    return ImageDetails(**image)
+        mask_values.append(value)
+    return ImageDetails(image_path, *image_values, mask_path, *mask_values)
 
 
 def _parse_frame(values, num_images):
     """Return Frame object from values parsed from frame text line"""
-    frame = {}
     try:
-        frame['image'] = int(values[0])
-        if frame['image'] < 0 or frame['image'] >= num_images:
+        image = int(values[0])
+        if image < 0 or image >= num_images:
             raise ValueError(
                 f'value must be an integer from 0 to {num_images}.')
     except IndexError:
@@ -154,26 +159,26 @@ def _parse_frame(values, num_images):
         raise ValueError(
             f'Frame has invalid image index "{values[0]}".')
     try:
-        frame['transparency'] = int(values[1])
-        if frame['transparency'] < 0 or frame['transparency'] > 7:
+        transparency = int(values[1])
+        if transparency < 0 or transparency > 7:
             raise ValueError('value must be an integer from 0 to 7.')
     except IndexError:
         raise ValueError('Frame misses transparency value.')
     except ValueError:
         raise ValueError(
             f'Frame has invalid transparency value "{values[1]}".')
-    index = 2
-    for prop in ('start', 'loop', 'mirror', 'end', 'continuous'):
+    flags = []
+    for index, prop in enumerate(Frame._fields[2:], 2):
         try:
-            frame[prop] = bool(int(values[index]))
+            flag = _FRAME_FLAGS.get(values[index])
         except IndexError:
             raise ValueError(f'Frame misses {prop} value.')
-        except ValueError:
+        if flag is None:
             raise ValueError(
                 f'Frame has invalid {prop} value "{values[index]}".'
                 ' Expected 0 or 1.')
-        index += 1
-    return Frame(**frame)
+        flags.append(flag)
+    return Frame(image, transparency, *flags)
 
 
 def _parse_animation(values, num_frames):
@@ -202,67 +207,88 @@ def load(path):
     root_dir = os.path.abspath(os.path.dirname(path))
 
     with open(path, 'rt') as text_file:
-        in_section = None
-        images = []
-        frames = []
-        animations = []
-        line_no = 0
-        loaded_images = {}
-
-        for line in text_file:
-            try:
-                line_no += 1
-                # Strip comments and whitespace:
-                stripped_line = line.split(';', 1)[0].strip()
-                if not stripped_line:
-                    continue
-                elif stripped_line.upper() == IMAGES_HEADER:
-                    if frames or animations:
-                        raise ValueError(
-                            f'{IMAGES_HEADER} must come before {FRAMES_HEADER}'
-                            f' and {ANIMATIONS_HEADER}.')
-                    in_section = Section.IMAGES
-                elif stripped_line.upper() == FRAMES_HEADER:
-                    if not images or animations:
-                        raise ValueError(
-                            f'{FRAMES_HEADER} must come after {IMAGES_HEADER}'
-                            f' and before {ANIMATIONS_HEADER}.')
-                    in_section = Section.FRAMES
-                elif stripped_line.upper() == ANIMATIONS_HEADER:
-                    if not images or not frames:
-                        raise ValueError(
-                            f'{ANIMATIONS_HEADER} must come after'
-                            f' {IMAGES_HEADER} and {FRAMES_HEADER}.')
-                    in_section = Section.ANIMATIONS
-                else:
-                    values = [v.strip() for v in stripped_line.split(',')]
-                    if in_section == Section.IMAGES:
-                        image_details = _parse_image_details(values, root_dir)
-                        if image_details in loaded_images:
-                            images.append(images[loaded_images[image_details]])
-                        else:
-                            images.append(image_details.load())
-                            loaded_images[image_details] = len(images) - 1
-                    elif in_section == Section.FRAMES:
-                        frames.append(
-                            _parse_frame(values, len(images)))
-                    elif in_section == Section.ANIMATIONS:
-                        animations.append(
-                            _parse_animation(values, len(frames)))
-            except ValueError as e:
-                raise ValueError(
-                    f'Error while loading {path}, line {line_no}') from e
+        lines = text_file.read().split('\n')
+
+    in_section = None
+    images = []
+    image_line_numbers = []
+    frames = []
+    animations = []
+
+    for line_no, line in enumerate(lines, 1):
+        try:
+            # Strip comments and whitespace:
+            stripped_line = line.partition(';')[0].strip()
+            if not stripped_line:
+                continue
+            # Only upper-case the rare lines that can be a section header:
+            header = stripped_line.upper() if stripped_line[0] == '@' else None
+            if header == IMAGES_HEADER:
+                if frames or animations:
+                    raise ValueError(
+                        f'{IMAGES_HEADER} must come before {FRAMES_HEADER}'
+                        f' and {ANIMATIONS_HEADER}.')
+                in_section = Section.IMAGES
+            elif header == FRAMES_HEADER:
+                if not images or animations:
+                    raise ValueError(
+                        f'{FRAMES_HEADER} must come after {IMAGES_HEADER}'
+                        f' and before {ANIMATIONS_HEADER}.')
+                in_section = Section.FRAMES
+            elif header == ANIMATIONS_HEADER:
+                if not images or not frames:
+                    raise ValueError(
+                        f'{ANIMATIONS_HEADER} must come after'
+                        f' {IMAGES_HEADER} and {FRAMES_HEADER}.')
+                in_section = Section.ANIMATIONS
+            else:
+                values = [v.strip() for v in stripped_line.split(',')]
+                if in_section == Section.IMAGES:
+                    # The images are loaded once all lines are parsed.
+                    images.append(_parse_image_details(values, root_dir))
+                    image_line_numbers.append(line_no)
+                elif in_section == Section.FRAMES:
+                    frames.append(
+                        _parse_frame(values, len(images)))
+                elif in_section == Section.ANIMATIONS:
+                    animations.append(
+                        _parse_animation(values, len(frames)))
+        except ValueError as e:
+            raise ValueError(
+                f'Error while loading {path}, line {line_no}') from e
+
+    sources = load_sources(dict.fromkeys(
+        source_path for image_details in images
+        for source_path in (image_details.image_path, image_details.mask_path)
+        if source_path is not None))
+    loaded_images = {}
+    for n, (image_details, line_no) in enumerate(
+            zip(images, image_line_numbers)):
+        try:
+            if image_details not in loaded_images:
+                loaded_images[image_details] = image_details.load(sources)
+            images[n] = loaded_images[image_details]
+        except ValueError as e:
+            raise ValueError(
+                f'Error while loading {path}, line {line_no}') from e
     return Sprite(images, frames, animations)
 
 
-def _image_details_to_text(details, root_dir):
-    image_path = os.path.relpath(details.image_path, root_dir)
+def _relative_path(path, root_dir, relative_paths):
+    """Return path relative to root_dir, caching it in dict relative_paths"""
+    if path not in relative_paths:
+        relative_paths[path] = os.path.relpath(path, root_dir)
+    return relative_paths[path]
+
+
+def _image_details_to_text(details, root_dir, relative_paths):
+    image_path = _relative_path(details.image_path, root_dir, relative_paths)
     text = (
         f'{image_path},{details.image_x: >4},{details.image_y: >4}'
         f',{details.width: >4},{details.height: >4}'
     )
     if details.mask_path is not None:
-        mask_path = os.path.relpath(details.mask_path, root_dir)
+        mask_path = _relative_path(details.mask_path, root_dir, relative_paths)
         if mask_path == image_path:
             mask_path = ''
         text += f', {mask_path},{details.mask_x: >4},{details.mask_y: >4}'
@@ -270,60 +296,63 @@ def _image_details_to_text(details, root_dir):
 
 
 def _get_images_text(sprite, image_details, root_dir):
-    text = IMAGES_HELP + '\n' + IMAGES_HEADER + '\n'
-    titles = iter(())  # No titles for images used by animations
+    lines = [IMAGES_HELP, IMAGES_HEADER]
+    titles = ()  # No titles for images used by animations
     if sprite.type == SpriteType.STATIC:
         # There are 5 images per unit. But use (1 + len) because it doesn't
-        # matter if the titles iterator is longer than the actual number of
-        # images. Don't break if someone decides they want to write a funny
-        # .spr file that does not have a multiple of 5 images.
-        titles = itertools.product(
-            [', Unit'], range(1 + len(image_details) // 5),
-            ['N', 'NE', 'E', 'SE', 'S'])
-    for n in range(len(image_details)):
-        details = _image_details_to_text(image_details[n], root_dir)
-        text += f'{details} ; {n}{" ".join(map(str, next(titles, "")))}\n'
-    return text
+        # matter if there are more titles than the actual number of images.
+        # Don't break if someone decides they want to write a funny .spr file
+        # that does not have a multiple of 5 images.
+        titles = [
+            f', Unit {unit} {direction}'
+            for unit in range(1 + len(image_details) // 5)
+            for direction in _UNIT_DIRECTIONS[0:5]]
+    # Most images are in the same few files:
+    relative_paths = {}
+    for n, image in enumerate(image_details):
+        details = _image_details_to_text(image, root_dir, relative_paths)
+        title = titles[n] if n < len(titles) else ''
+        lines.append(f'{details} ; {n}{title}')
+    lines.append('')  # End with a newline
+    return '\n'.join(lines)
 
 
 def save(sprite, path):
     """Save Sprite object 'sprite' to .txt file 'path'"""
 
-    # Open text file early, so we already own it when writing the images:
-    with open(path, 'xt') as f:
-        try:
-            img_list = sprite.save_as_pngs(os.path.splitext(path)[0])
-        except FileExistsError as e:
-            # But if creating the image directory failed, we have no use for
-            # the text file anymore either:
-            f.close()
-            os.remove(f.name)
-            raise FileExistsError('Image directory already exists.') from e
-        f.write(_get_images_text(sprite, img_list, os.path.dirname(path)))
-        if sprite.has_animations:
-            f.write('\n')
-            f.write(FRAMES_HELP + '\n')
-            f.write(FRAMES_HEADER + '\n')
-            for n, frame in enumerate(sprite.frames):
-                f.write(
-                    f'{", ".join(map(lambda x: str(int(x)), frame)): <24}'
-                    f' ; frame {n}\n')
-            f.write('\n')
-            f.write(ANIMATIONS_HELP + '\n')
-            f.write(ANIMATIONS_HEADER + '\n')
-            titles = None
-            if sprite.type == SpriteType.UNIT:
-                actions = ['Attack', 'Die', 'Idle', 'Move']
-                directions = ['N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW']
-                titles = itertools.product(actions, directions)
-            elif sprite.type == SpriteType.RESOURCES:
-                titles = itertools.product(
-                    ['Map'], range(4),
-                    ['Resource'], range(2),
-                    ['Terrain'], range(len(sprite.animation_index) // 8))
-            for animation in sprite.animation_index:
-                if titles:
-                    f.write(f'{animation: <4}')
-                    f.write(f' ; {" ".join(map(str, next(titles)))}\n')
-                else:
-                    f.write(f'{animation}')
+    # Create text file early, so we already own it when writing the images.
+    # It is only opened for writing once the images are done:
+    open(path, 'xt').close()
+    try:
+        img_list = sprite.save_as_pngs(os.path.splitext(path)[0])
+    except FileExistsError as e:
+        # But if creating the image directory failed, we have no use for the
+        # text file anymore either:
+        os.remove(path)
+        raise FileExistsError('Image directory already exists.') from e
+    parts = [_get_images_text(sprite, img_list, os.path.dirname(path))]
+    if sprite.has_animations:
+        parts.append('\n')
+        parts.append(FRAMES_HELP + '\n')
+        parts.append(FRAMES_HEADER + '\n')
+        for n, frame in enumerate(sprite.frames):
+            parts.append(
+                f'{_FRAME_FORMAT.format(*frame): <24} ; frame {n}\n')
+        parts.append('\n')
+        parts.append(ANIMATIONS_HELP + '\n')
+        parts.append(ANIMATIONS_HEADER + '\n')
+        titles = None
+        if sprite.type == SpriteType.UNIT:
+            titles = _UNIT_ANIMATION_TITLES
+        elif sprite.type == SpriteType.RESOURCES:
+            titles = [
+                f'Map {m} Resource {r} Terrain {t}'
+                for m in range(4) for r in range(2)
+                for t in range(len(sprite.animation_index) // 8)]
+        for n, animation in enumerate(sprite.animation_index):
+            if titles is not None and n < len(titles):
+                parts.append(f'{animation: <4} ; {titles[n]}\n')
+            else:
+                parts.append(f'{animation}\n')
+    with open(path, 'wt') as f:
+        f.write(''.join(parts))
@@ -9,14 +9,19 @@ Each file format conversion module should expose the following two functions:
 """
 
 import collections
+import concurrent.futures
 import enum
 import os
 
-from PIL import Image, ImageChops, ImageOps
+from PIL import Image, ImageChops
 
 
 TRANSPARENT = (255, 0, 255, 0)  # Magenta with no civ mask (RGBA)
 BORDER_COLOR = (0, 255, 0, 0)
+# The PNGs are meant for editing, not distribution, so favor speed over size:
+PNG_COMPRESS_LEVEL = 1
+# point() table for masks: any non-zero value means the pixel is masked.
+_MASK_LUT = [0] + [255] * 255
 
 
 class ImageDetails(collections.namedtuple('ImageDetails', [
@@ -56,10 +61,18 @@ class ImageDetails(collections.namedtuple('ImageDetails', [
     def __hash__(self):
         return hash(tuple(self))
 
-    def load(self):
-        """Return PIL Image object from ImageDetails object"""
-        source = Image.open(self.image_path)
-        image = source.crop(self.image_box)
+    def load(self, sources=None):
+        """Return PIL Image object from ImageDetails object
+
+        sources - optional dict of already opened source Image objects, like
+                  the one load_sources() returns. Newly opened sources are
+                  added to it, so passing the same dict when loading many
+                  images means each source file is only opened and decoded
+                  once.
+        """
+        if sources is None:
+            sources = {}
+        image = _open_source(self.image_path, sources).crop(self.image_box)
         # Treat the color of the top-left pixel as transparent too, since ToT
         # does that for its bitmaps.
         extra_transparent = image.getpixel((0, 0))
@@ -71,14 +84,46 @@ class ImageDetails(collections.namedtuple('ImageDetails', [
             image.paste(TRANSPARENT, mask=extra_filter)
         mask = 0
         if self.mask_path is not None:
-            if self.mask_path != self.image_path:
-                source = Image.open(self.mask_path)
-            mask = source.crop(self.mask_box).convert('L').point(
-                lambda p: p, '1')
+            source = _open_source(self.mask_path, sources)
+            mask = source.crop(self.mask_box).convert('L').point(_MASK_LUT)
         image.putalpha(mask)
         return image
 
 
+def _source_key(path):
+    """Return sources dict key, which is the same for all paths to a file"""
+    return os.path.normcase(os.path.realpath(path))
+
+
+def _open_source(path, sources):
+    """Return Image object for path from dict sources, opening it if needed"""
+    key = _source_key(path)
+    if key not in sources:
+        sources[key] = Image.open(path)
+    return sources[key]
+
+
+def load_sources(paths):
+    """Return dict of decoded source Image objects for ImageDetails.load()
+
+    Decoding is the slow part of loading images, but Pillow releases the GIL
+    while doing that, so the files at the given paths are decoded in
+    parallel.
+    """
+    def load_source(path):
+        source = Image.open(path)
+        source.load()
+        return source
+
+    # Different paths to the same file only need to be decoded once:
+    unique_paths = {}
+    for path in paths:
+        unique_paths.setdefault(_source_key(path), path)
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        return dict(zip(
+            unique_paths, executor.map(load_source, unique_paths.values())))
+
+
 Frame = collections.namedtuple('Frame', [
     'image', 'transparency',
     'start', 'loop', 'mirror', 'end', 'continuous'])
@@ -144,16 +189,19 @@ class Sprite(object):
     def get_images_in_animation(self, start_frame):
         """Return list of unique images in animation starting at start_frame"""
         images = []
+        image_ids = set()
         for frame in self.frames[start_frame:]:
             # Exclude the end frame because it's not displayed:
             if frame.end:
                 break
-            # Use all() because a plain "in" does an equality check, not an
+            # Compare ids because a plain "in" does an equality check, not an
             # identity check, which would then exclude frames that look the
             # same in other animations. We now potentially save more duplicate
             # images, but hopefully cause less confusion for animation authors.
-            if all(i is not self.images[frame.image] for i in images):
-                images.append(self.images[frame.image])
+            image = self.images[frame.image]
+            if id(image) not in image_ids:
+                image_ids.add(id(image))
+                images.append(image)
             if frame.loop:
                 break
         return images
@@ -177,27 +225,47 @@ class Sprite(object):
         os.makedirs(images_dir)
 
         saved_details = [None] * len(self.images)
-        saved_images = []
+        saved_image_ids = set()
+        pending_saves = []
+
+        # Same results as find_matching_image_indexes(), but without going
+        # through all images for every saved image:
+        indexes_by_id = collections.defaultdict(list)
+        indexes_by_content = collections.defaultdict(list)
+        for n, img in enumerate(self.images):
+            indexes_by_id[id(img)].append(n)
+            if not self.has_animations:  # Only static sprites use equality
+                indexes_by_content[_content_key(img)].append(n)
+
+        def matching_image_indexes(image, identical):
+            if identical:
+                return indexes_by_id[id(image)]
+            return [
+                n for n in indexes_by_content[_content_key(image)]
+                if self.images[n] == image
+            ]
 
         def save_and_update_progress(image_list, image_path, identical):
-            image_details = save_images_to_file(
+            total_image, image_details = combine_images(
                 image_list, image_path, borders)
-            saved_images.extend(image_list)
+            if total_image is not None:
+                pending_saves.append((total_image, image_path))
+            saved_image_ids.update(map(id, image_list))
             for n, img in enumerate(image_list):
-                for idx in self.find_matching_image_indexes(img, identical):
+                for idx in matching_image_indexes(img, identical):
                     saved_details[idx] = image_details[n]
 
         if self.has_animations:
-            seen_animations = []
+            seen_animations = set()
             for n, start_frame in enumerate(self.animation_index):
                 if start_frame in seen_animations:
                     continue
-                seen_animations.append(start_frame)
+                seen_animations.add(start_frame)
                 # All images that have not already been saved:
                 anim_images = [
                     img for img in self.get_images_in_animation(start_frame)
                     # Check identity, not just equality:
-                    if all(i is not img for i in saved_images)
+                    if id(img) not in saved_image_ids
                 ]
                 if anim_images:
                     image_path = os.path.join(
@@ -217,75 +285,115 @@ class Sprite(object):
                 save_and_update_progress(
                     unused[i:i + row_size], image_path, identical=True)
         else:
-            static_images = list(self.images)
             directions = 5  # facing directions per unit
-            unit = 0
-            while static_images:
+            unit_starts = range(0, len(self.images), directions)
+            for unit, start in enumerate(unit_starts):
                 image_path = os.path.join(images_dir, f'unit-{unit:03d}.png')
                 current_images = []
-                for img in static_images[0:directions]:
+                end = min(start + directions, len(self.images))
+                for n in range(start, end):
+                    img = self.images[n]
                     # Doing equality check here unlike for animations, because
                     # I don't expect de-duplicating equal images in static
-                    # sprites will be as confusing.
-                    if img not in saved_images and img not in current_images:
+                    # sprites will be as confusing. Images equal to one saved
+                    # for an earlier unit already have their details:
+                    if saved_details[n] is None and img not in current_images:
                         current_images.append(img)
                 save_and_update_progress(
                     current_images, image_path, identical=False)
-                static_images = static_images[directions:]
-                unit += 1
+        # Encoding the PNGs is the slow part, but Pillow releases the GIL
+        # while doing that, so they can be saved in parallel:
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            saves = [executor.submit(save_image, *s) for s in pending_saves]
+            for save in saves:
+                save.result()  # Re-raise any exception from the threads
         assert all(saved_details), "Not all images were saved"
         return saved_details
 
 
+def _content_key(image):
+    """Return hashable key that is the same for all images that are equal"""
+    return (image.mode, image.size, hash(image.tobytes()))
+
+
 def save_images_to_file(images, path, borders=True):
     """Save list of Image objects to path and return list of ImageDetails
 
     The items in the returned list correspond to the images passed in.
     """
+    total_image, all_image_details = combine_images(images, path, borders)
+    if total_image is not None:
+        save_image(total_image, path)
+    return all_image_details
+
+
+def save_image(image, path):
+    """Save Image object to PNG file path, which must not exist yet"""
+    with open(path, 'xb') as f:
+        image.save(f, 'PNG', compress_level=PNG_COMPRESS_LEVEL)
+
+
+def combine_images(images, path, borders=True):
+    """Return Image combining list of Image objects and list of ImageDetails
+
+    The returned ImageDetails refer to where each image will be found once
+    the combined image is saved to path. The items in the returned list
+    correspond to the images passed in. If there are no images, the returned
+    Image is None.
+    """
     all_image_details = []
     if not images:
-        return all_image_details
-    total_width = int(borders)
+        return None, all_image_details
+    path = os.path.abspath(path)
+    border = int(borders)  # Border width in pixels
+    total_width = border
     max_height = 0
-    any_masks = False
     for img in images:
-        total_width += img.width + int(borders)
+        total_width += img.width + border
         max_height = max(max_height, img.height)
-        any_masks = any_masks or 255 in img.getdata(3)
-    total_height = max_height + 2 * int(borders)
+    # The alpha channel is the mask, so check for its maximum value. Stop at
+    # the first image with a mask, but keep the bands checked so far for
+    # creating the masks:
+    alphas = []
+    any_masks = False
+    for img in images:
+        alphas.append(img.getchannel('A'))
+        if alphas[-1].getextrema()[1] == 255:
+            any_masks = True
+            break
+    total_height = max_height + 2 * border
     if any_masks:
-        total_height += max_height + int(borders)
+        total_height += max_height + border
     total_image = Image.new('RGB', (total_width, total_height), TRANSPARENT)
+    mask_top = border + max_height
     left = 0
-    for img in images:
+    if any_masks:
+        alphas.extend(img.getchannel('A') for img in images[len(alphas):])
+    for n, img in enumerate(images):
         current_mask = None
         if any_masks:
-            current_mask = Image.new('1', img.size, None)
-            current_mask.putdata(img.getdata(3))
-            if borders:
-                current_mask = ImageOps.expand(
-                    current_mask.convert('RGB'), int(borders), BORDER_COLOR)
+            current_mask = alphas[n].point(_MASK_LUT)
+        # Paste the images onto a rectangle of the border color, rather than
+        # creating a copy of each image with the border around it:
+        image_box = (
+            left, 0, left + img.width + 2 * border, img.height + 2 * border)
         if borders:
-            current_image = ImageOps.expand(
-                img, int(borders), BORDER_COLOR)
-        else:
-            current_image = img
-        image_box = (left, 0, left + current_image.width, current_image.height)
-        total_image.paste(current_image, image_box)
+            total_image.paste(BORDER_COLOR, image_box)
+        total_image.paste(img, (left + border, border))
         if current_mask:
             mask_box = (
-                left, int(borders) + max_height,
-                left + current_mask.width,
-                int(borders) + max_height + current_mask.height)
-            total_image.paste(current_mask, mask_box)
+                left, mask_top,
+                left + img.width + 2 * border,
+                mask_top + img.height + 2 * border)
+            if borders:
+                total_image.paste(BORDER_COLOR, mask_box)
+            total_image.paste(current_mask, (left + border, mask_top + border))
         all_image_details.append(ImageDetails(
-            os.path.abspath(path),
-            int(borders) + left, int(borders),
+            path,
+            border + left, border,
             img.width, img.height,
-            os.path.abspath(path) if current_mask else None,
-            int(borders) + left if current_mask else None,
-            2 * int(borders) + max_height if current_mask else None))
-        left += img.width + int(borders)
-    with open(path, 'xb') as f:
-        total_image.save(f)
-    return all_image_details
+            path if current_mask else None,
+            border + left if current_mask else None,
+            2 * border + max_height if current_mask else None))
+        left += img.width + border
+    return total_image, all_image_details